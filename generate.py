@@ -31,6 +31,10 @@ MAKE_MAGNET_HOLE = False
 # Make holes on the bottom for screws.
 MAKE_SCREW_HOLE = False
 
+# How much smaller (in mm) the outside of the box is than the grid it sits in.
+# Set to 0 to skip shaving the outer shell entirely. Must be below 2.8mm.
+SHELL_CLEARANCE = 0.5
+
 
 
 # Make the properties object to be passed to the make_box method.
@@ -42,7 +46,8 @@ properties = Properties(
     DRAW_FINGER_SCOOP,
     DRAW_LABEL_LEDGE,
     MAKE_MAGNET_HOLE,
-    MAKE_SCREW_HOLE)
+    MAKE_SCREW_HOLE,
+    SHELL_CLEARANCE)
 
 
 # This makes the box, writes it to an output STL, and returns it.
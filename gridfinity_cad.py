@@ -0,0 +1,558 @@
+# STDLIB
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import warnings
+from collections import defaultdict
+from contextlib import suppress
+from functools import lru_cache
+from weakref import WeakKeyDictionary
+from typing import Callable, Dict, Iterable, List, Tuple, Union, Optional, Literal
+
+# EXT
+# at the Moment cadquery2 is still under development
+# on windows You need to use version cadquery==2.20b0 (2022-08-24)
+if platform.system() == "Windows" :
+    import cadquery as cq                                   # noqa
+    from cadquery import Workplane, Vector, Location        # noqa
+else:
+    import cadquery2 as cq                                  # noqa
+    from cadquery2 import Workplane, Vector, Location       # noqa
+
+# LOCAL
+from gridfinity import (
+    BOTTOM_THICKNESS,
+    CacheWriteWarning,
+    Properties,
+    cache_key,
+    mesh_tolerance,
+    plan_layout,
+    warn_small_drawers
+)
+
+
+CACHE_DIR = os.path.join(".cache", "gridfinity")
+
+_svg_cache: "WeakKeyDictionary[Workplane, Tuple[tuple, Dict[str, str]]]" = (
+    WeakKeyDictionary()
+)
+
+
+def _build_bucket_sketch(
+    width: float,
+    height: float,
+    centers: List[Tuple[float, float]]
+) -> cq.Sketch:
+    return (
+        cq.Sketch()
+        .push(centers)
+        .rect(width, height)
+        .reset()
+        .vertices()
+        .fillet(3)
+    )
+
+
+@lru_cache(maxsize=128)
+def _rounded_rect(
+    width: float,
+    length: float,
+    radius: float
+) -> cq.Sketch:
+    # The result is shared between callers, only ever use moved() copies of it.
+    return (
+        cq.Sketch()
+        .rect(width, length)
+        .vertices().fillet(radius)
+    )
+
+
+def _finger_scoops(
+    front: Workplane,
+    prop: Properties
+) -> cq.Shape:
+
+    scoop_radius = min(prop.height * 0.6, prop.bucket_length * 0.9)
+
+    offsets = [i * (prop.bucket_length + 1) for i in range(prop.units_long)]
+    offsets[0] += 1.6
+    half = (prop.units_long - 1) / 2
+
+    x_origin = (scoop_radius / 2 -
+                0.5 * prop.bucket_length * prop.units_long -
+                half)
+    y_origin = scoop_radius / 2 - (prop.height - BOTTOM_THICKNESS) / 2
+
+    # Each circle may only cut its own square, so the profile is built
+    # once on its own and then copied to every row.
+    profile = (
+        cq.Sketch()
+        .rect(scoop_radius, scoop_radius)
+        .vertices(">X and >Y")
+        .circle(scoop_radius, mode="s")
+    )
+    sketch = (
+        cq.Sketch()
+        .push([(x_origin + offset, y_origin) for offset in offsets])
+        .face(profile)
+    )
+
+    return (
+        front
+        .placeSketch(sketch)
+        .extrude(prop.width - 1, combine=False)
+        .val()
+    )
+
+
+def _label_ledges(
+    front: Workplane,
+    prop: Properties
+) -> cq.Shape:
+
+    ledge_length = 12 + 0.75
+    back_ledge_offset = 2.9
+
+    max_ledge_height = prop.height - BOTTOM_THICKNESS
+
+    offsets = [i * (prop.bucket_length + 1) for i in range(prop.units_long)]
+    last_offsets = [0] * (prop.units_long - 1) + [back_ledge_offset]
+
+    sketches = []
+    for offset, last_offset in zip(offsets, last_offsets):
+        ledge_height = min(max_ledge_height, ledge_length + last_offset)
+
+        sketch = (
+            cq.Sketch()
+            .segment((last_offset, -ledge_height), (last_offset, 0))
+            .segment((-ledge_length, 0))
+        )
+
+        if ledge_height < ledge_length:
+            sketch = sketch.segment(
+                (-ledge_length + ledge_height, -ledge_height))
+
+        sketch = (
+            sketch
+            .close()
+            .assemble()
+            .vertices("<X")
+            .fillet(0.6)
+            .moved(Location(Vector(
+                - 0.5 - (0.5 * prop.units_long - 1) * (prop.bucket_length + 1),
+                (prop.height - BOTTOM_THICKNESS) / 2)))
+            .moved(Location(Vector(
+                offset - last_offset,
+                0
+            )))
+        )
+        sketches.append(sketch)
+
+    return (
+        front
+        .placeSketch(*sketches)
+        .extrude(prop.width - 1.5, combine=False)
+        .val()
+    )
+
+
+class GridfinityWorkplane(Workplane):
+
+    def drawBase(
+        self
+    ) -> "GridfinityWorkplane":
+        return (
+            self
+            .box(37.2, 37.2, 2.6, (True, True, False))
+            .edges("|Z").fillet(1.6)
+            .faces("<Z").chamfer(0.8)
+            .faces(">Z")
+            .box(42, 42, 2.4, (True, True, False))
+            .edges("|Z and (>Y or <Y)").fillet(4)
+            .faces(">>Z[-2]").edges("<Z").chamfer(2.39999999)
+        )
+
+    def drawBases(
+        self,
+        prop: Properties
+    ) -> "GridfinityWorkplane":
+        base_solid = GridfinityWorkplane().drawBase().val()
+
+        locations = [
+            Location(Vector(
+                i * 42 - (prop.units_wide - 1) * 21,
+                j * 42 - (prop.units_long - 1) * 21,
+                0
+            ))
+            for i in range(prop.units_wide)
+            for j in range(prop.units_long)
+        ]
+
+        return self.newObject([cq.Compound.makeCompound(
+            [base_solid.located(loc) for loc in locations]
+        )])
+
+    def drawBuckets(
+        self,
+        prop: Properties
+    ) -> "GridfinityWorkplane":
+
+        widths, x_origins, y_origins = plan_layout(prop)
+
+        # Buckets of equal size share one sketch, there are rarely more than
+        # a few distinct widths per box.
+        groups = defaultdict(list)
+        for width, x_origin, y_origin in zip(widths, x_origins, y_origins):
+            groups[width].append((
+                -prop.width / 2 + x_origin + width / 2,
+                prop.length / 2 - y_origin - prop.bucket_length / 2
+            ))
+
+        sketches = [
+            _build_bucket_sketch(width, prop.bucket_length, centers)
+            for width, centers in groups.items()
+        ]
+
+        return (
+            self
+            .faces("<Z[0]").workplane(centerOption="CenterOfBoundBox").tag("base")
+            .box(prop.width, prop.length, prop.height, (True, True, False))
+            .edges("|Z").fillet(4)
+            .faces(">Z")
+            .workplane()
+            .placeSketch(*sketches)
+            .extrude(BOTTOM_THICKNESS - prop.height, "cut")
+        )
+
+    def drawMate(
+        self,
+        prop: Properties
+    ) -> "GridfinityWorkplane":
+
+        width = prop.width - prop.shell_clearance
+        length = prop.length - prop.shell_clearance
+        outer_fillet = 4 - prop.shell_clearance / 2
+
+        s1 = _rounded_rect(width, length, outer_fillet)
+        s2 = _rounded_rect(width - 1.9 * 2, length - 1.9 * 2, outer_fillet - 1.9)
+        s3 = _rounded_rect(width - 2.6 * 2, length - 2.6 * 2, outer_fillet - 2.6)
+        s4 = _rounded_rect(width - 1 * 2, length - 1 * 2, outer_fillet - 1)
+
+        top = (
+            GridfinityWorkplane().copyWorkplane(
+                self.workplaneFromTagged("base")
+                .workplane(offset=prop.height - 2.84)
+            )
+            .box(width, length, 7.24, (True, True, False))
+            .edges("|Z").fillet(outer_fillet)
+            .faces(">Z")
+            .placeSketch(
+                s1.moved(Location(Vector(0, 0, 0))),
+                s2.moved(Location(Vector(0, 0, -1.9))),
+                s2.moved(Location(Vector(0, 0, -3.7))),
+                s3.moved(Location(Vector(0, 0, -4.4))),
+                s3.moved(Location(Vector(0, 0, -5.6))),
+                s4.moved(Location(Vector(0, 0, -7.24)))
+            )
+            .loft(True, "s")
+        )
+
+        # Fused here rather than batched with the earlier features:
+        # drawMagnetBoreHoles and shaveOuterShell both start from the topmost
+        # face, which is the lip's.
+        return self.union(top)
+
+    def drawFrontSurface(
+        self,
+        prop: Properties
+    ) -> "GridfinityWorkplane":
+        return (
+            self.faces(">Z[3]")
+            .workplane()
+            .transformed(offset=(0, -prop.length / 2 + 1))
+            .box(prop.width, 1.85, prop.height - 2, (True, False, False))
+        )
+
+    def drawFrontFeatures(
+        self,
+        prop: Properties
+    ) -> "GridfinityWorkplane":
+
+        if not (prop.draw_finger_scoop or prop.draw_label_ledge):
+            return self
+
+        front = (
+            self.faces(">X[1]")
+            .workplane(centerOption="CenterOfBoundBox").tag("front")
+        )
+
+        features = []
+        if prop.draw_finger_scoop:
+            features.append(_finger_scoops(front, prop))
+        if prop.draw_label_ledge:
+            features.append(_label_ledges(front, prop))
+
+        # Scoops and ledges are fused into the body in a single boolean. The
+        # front surface cannot join them: it trims the ">X[1]" faces that
+        # place the "front" workplane, so it has to be fused beforehand.
+        return front.newObject([front.findSolid().fuse(*features).clean()])
+
+    def drawMagnetBoreHoles(
+        self,
+        prop: Properties
+    ) -> "GridfinityWorkplane":
+
+        self.plane.zDir = Vector(0, 0, -1)
+        if not (prop.make_magnet_hole or prop.make_screw_hole):
+            return self
+
+        self = (
+            self
+            .faces("<Z[-1]")
+            .faces(cq.selectors.AreaNthSelector(-1))
+            .rect(26, 26, forConstruction=True)
+            .vertices()
+        )
+
+        if prop.make_screw_hole is True:
+            self = self.cboreHole(3, 6.5, 2.4, 6)
+        elif prop.make_magnet_hole is True:
+            self = self.hole(6.5, 2.4)
+
+        return self
+
+    def shaveOuterShell(
+        self,
+        prop: Properties
+    ) -> "GridfinityWorkplane":
+
+        if prop.shell_clearance == 0:
+            return self
+
+        return (
+            self
+            .faces("<Z[-1]")
+            .faces(cq.selectors.AreaNthSelector(-1))
+            .workplane(centerOption="CenterOfBoundBox")
+            .sketch()
+            .rect(prop.width, prop.length, tag="outer")
+            .rect(prop.width - prop.shell_clearance,
+                  prop.length - prop.shell_clearance, mode="s", tag="inner")
+            .vertices(tag="outer")
+            .vertices(tag="inner").fillet(4 - prop.shell_clearance / 2)
+            .finalize()
+            .cutThruAll()
+        )
+
+
+def _plane_to_json(
+    plane: cq.Plane
+) -> List[Tuple[float, float, float]]:
+    return [plane.origin.toTuple(), plane.xDir.toTuple(), plane.zDir.toTuple()]
+
+
+def _plane_from_json(
+    values: List[Tuple[float, float, float]]
+) -> cq.Plane:
+    origin, x_dir, normal = values
+    return cq.Plane(origin, x_dir, normal)
+
+
+def _load_cached_box(
+    cache_file: str
+) -> Optional[GridfinityWorkplane]:
+    planes_file = cache_file + ".planes.json"
+    if not (os.path.isfile(cache_file) and os.path.isfile(planes_file)):
+        return None
+    try:
+        with open(planes_file) as f:
+            planes = json.load(f)
+        shape = cq.Shape.importBrep(cache_file)
+    except Exception:
+        # A damaged cache entry is not fatal, the box is simply rebuilt.
+        return None
+
+    # Restore the current and the tagged workplanes so that further
+    # operations on a cached box land where they would on a fresh one.
+    box = GridfinityWorkplane(_plane_from_json(planes["plane"])).add(shape)
+    for name, values in planes["tags"].items():
+        box.copyWorkplane(
+            GridfinityWorkplane(_plane_from_json(values))
+        ).tag(name)
+    return box
+
+
+def _write_atomically(
+    path: str,
+    write: Callable[[str], object]
+) -> None:
+    # Written under a temporary name and renamed into place so that neither
+    # an interrupted run nor a concurrent reader ever sees a partial file.
+    fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        write(tmp_file)
+        os.replace(tmp_file, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
+
+def _store_cached_box(
+    box: GridfinityWorkplane,
+    cache_file: str
+) -> None:
+    planes = {
+        "plane": _plane_to_json(box.plane),
+        "tags": {
+            name: _plane_to_json(tagged.plane)
+            for name, tagged in box.ctx.tags.items()
+        }
+    }
+
+    def write_planes(path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(planes, f)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # The BREP goes last: its presence marks the entry as complete.
+    _write_atomically(cache_file + ".planes.json", write_planes)
+    _write_atomically(cache_file, box.val().exportBrep)
+
+
+def make_box(
+    prop: Properties,
+    out_file: Union[str, None] = None,
+    export_type: Optional[Literal["STL", "STEP", "AMF",
+                                  "SVG", "TJS", "DXF", "VRML", "VTP"]] = None,
+    tolerance: Optional[float] = None,
+    angular_tolerance: float = 0.1,
+    opt=None,
+    use_cache: bool = True
+) -> Workplane:
+    warn_small_drawers(prop)
+
+    cache_file = os.path.join(CACHE_DIR, f"{cache_key(prop)}.brep")
+
+    box = _load_cached_box(cache_file) if use_cache else None
+    if box is None:
+        box = (
+            GridfinityWorkplane()
+            .drawBases(prop)
+            .drawBuckets(prop)
+            .drawFrontSurface(prop)
+            .drawFrontFeatures(prop)
+            .drawMate(prop)
+            .drawMagnetBoreHoles(prop)
+            .shaveOuterShell(prop)
+        )
+        if use_cache:
+            # Caching is an optimisation only, a failed write must not cost
+            # the caller the box that was just built.
+            try:
+                _store_cached_box(box, cache_file)
+            except OSError as e:
+                warnings.warn(
+                    f"Could not write cache entry {cache_file}: {e}",
+                    CacheWriteWarning
+                )
+
+    if tolerance is None:
+        tolerance = prop.mesh_tolerance
+
+    if out_file:
+        export_box(
+            box,
+            out_file=out_file,
+            export_type=export_type,
+            tolerance=tolerance,
+            angular_tolerance=angular_tolerance,
+            opt=opt
+        )
+    return box
+
+
+def _make_box_file(
+    prop: Properties,
+    out_file: str
+) -> str:
+    # Workplanes cannot be pickled, so workers only hand back the file name.
+    make_box(prop, out_file)
+    return out_file
+
+
+def parallel_boxes(
+    props_filename_pairs: Iterable[Tuple[Properties, str]],
+    workers: Optional[int] = None
+) -> List[str]:
+    with multiprocessing.Pool(workers) as pool:
+        return pool.starmap(_make_box_file, props_filename_pairs)
+
+
+def export_box(
+    box: Workplane,
+    out_file: Union[str, None] = None,
+    export_type: Optional[Literal["STL", "STEP", "AMF",
+                                  "SVG", "TJS", "DXF", "VRML", "VTP"]] = None,
+    tolerance: Optional[float] = None,
+    angular_tolerance: float = 0.1,
+    opt=None
+) -> Workplane:
+    if tolerance is None:
+        # Boxes are a whole number of 42mm units, less the shell clearance.
+        bounds = box.val().BoundingBox()
+        tolerance = mesh_tolerance(
+            round(bounds.xlen / 42), round(bounds.ylen / 42))
+
+    cq.exporters.export(
+        box,
+        out_file,
+        exportType=export_type,
+        tolerance=tolerance,
+        angularTolerance=angular_tolerance,
+        opt=opt
+    )
+    return box
+
+
+def export_svg(
+    box: Workplane,
+    out_file: Union[str, None] = None,
+    opt=None
+) -> Workplane:
+
+    settings = {
+        "showAxes": False,
+        "marginLeft": 10,
+        "marginTop": 10,
+        "projectionDir": (2.75, -2.6, 2),
+        "showHidden": False,
+        "focus": 500
+    }
+    if opt:
+        settings.update(opt)
+
+    # Hidden line removal dominates SVG export, so each rendering is kept for
+    # as long as the box is alive and reused when exported again. Workplane.add
+    # changes a box in place, so renders only count while it holds the very
+    # same objects they were made from.
+    objects, renders = _svg_cache.get(box, ((), {}))
+    if len(objects) != len(box.objects) or any(
+        cached is not current for cached, current in zip(objects, box.objects)
+    ):
+        objects, renders = tuple(box.objects), {}
+        _svg_cache[box] = (objects, renders)
+
+    key = repr(sorted(settings.items()))
+    if key not in renders:
+        renders[key] = cq.exporters.svg.getSVG(
+            cq.exporters.toCompound(box), settings)
+
+    if out_file:
+        with open(out_file, "w") as f:
+            f.write(renders[key])
+
+    return box